@@ -8,6 +8,9 @@ from twisted.internet import reactor, protocol
 from twisted.python import log
 import pybonjour
 
+# Set to True to log every Bonjour callback.
+_DEBUG = False
+
 class Echo(protocol.Protocol):
     """This is just about the simplest possible protocol"""
 
@@ -38,19 +41,22 @@ class BonjourEchoFactory(protocol.ServerFactory):
 
     def registrationCallback(self, sdRef,flags,errorCode,name,regtype,domain):
         if errorCode == pybonjour.kDNSServiceErr_NoError:
-            print "registration!:", errorCode, name, regtype, domain
+            log.msg("registration!: %s %s %s %s"
+                    % (errorCode, name, regtype, domain))
         else:
-            print "Bonjour registration error"
+            log.msg("Bonjour registration error: %s" % errorCode)
 
     def resolveCallback(self,sdRef, flags, interfaceIndex, errorCode, fullname,
                      hosttarget, port, txtRecord):
-        log.msg("resolveCallback")
+        if _DEBUG:
+            log.msg("resolveCallback")
         if errorCode == pybonjour.kDNSServiceErr_NoError:
-            print 'Resolved service:'
-            print '  fullname   =', fullname
-            print '  hosttarget =', hosttarget
-            print '  port       =', port
-        
+            log.msg('Resolved service:\n'
+                    '  fullname   = %s\n'
+                    '  hosttarget = %s\n'
+                    '  port       = %s'
+                    % (fullname, hosttarget, port))
+
 
     def startFactory(self):
         self.browser = BonjourBrowser("_echo._tcp", self.resolveCallback, reactor)
@@ -0,0 +1,301 @@
+# encoding: utf-8
+"""Tests for twistbonjour."""
+
+import os
+import resource
+import socket
+
+import pybonjour
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+import twistbonjour
+
+
+class FakeServiceRef(object):
+    """Stands in for a pybonjour DNSServiceRef.
+
+    It owns one end of a socket pair, so it has a real fd that can be made
+    readable by writing to the other end.
+    """
+
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self.closed = False
+        self.sock, self.peer = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.closed = True
+
+    def dispose(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class FakeReactor(task.Clock):
+    """A Clock that also tracks readers.  It is not running, so closes are
+    synchronous."""
+
+    running = False
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.readers = set()
+
+    def addReader(self, reader):
+        self.readers.add(reader)
+
+    def removeReader(self, reader):
+        self.readers.discard(reader)
+
+
+class FakeThreadPool(object):
+    """Records work instead of running it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        self.calls.append(func)
+
+
+class RunningReactor(FakeReactor):
+    """A FakeReactor that claims to be running and has a thread pool."""
+
+    running = True
+
+    def __init__(self):
+        FakeReactor.__init__(self)
+        self.threadpool = FakeThreadPool()
+
+    def getThreadPool(self):
+        return self.threadpool
+
+
+class FakeRefMixin(object):
+    """Creates FakeServiceRefs and disposes of them after the test."""
+
+    def makeRef(self, name=None, callback=None):
+        ref = FakeServiceRef(name, callback)
+        self.addCleanup(ref.dispose)
+        return ref
+
+
+class BonjourBrowserTestCase(FakeRefMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.resolves = []
+        self.results = []
+        self.patch(pybonjour, 'DNSServiceBrowse', self.fakeBrowse)
+        self.patch(pybonjour, 'DNSServiceResolve', self.fakeResolve)
+        self.browser = twistbonjour.BonjourBrowser(
+            '_echo._tcp', self.resolveCallback, self.reactor)
+        self.browser.startBrowsing()
+
+    def fakeBrowse(self, flags, interfaceIndex, regtype, domain, callback):
+        return self.makeRef(None, callback)
+
+    def fakeResolve(self, flags, interfaceIndex, name, regtype, domain,
+                    callback):
+        ref = self.makeRef(name, callback)
+        self.resolves.append(ref)
+        return ref
+
+    def resolveCallback(self, *args):
+        self.results.append((args[4], args[6]))
+
+    def add(self, name):
+        self.browser.browseCallback(None, pybonjour.kDNSServiceFlagsAdd, 0,
+                                    pybonjour.kDNSServiceErr_NoError, name,
+                                    '_echo._tcp', 'local')
+
+    def remove(self, name):
+        self.browser.browseCallback(None, 0, 0,
+                                    pybonjour.kDNSServiceErr_NoError, name,
+                                    '_echo._tcp', 'local')
+
+    def reply(self, ref, port=1234):
+        ref.callback(ref, 0, 0, pybonjour.kDNSServiceErr_NoError, ref.name,
+                     'host.local.', port, '')
+
+    def test_oneResolverPerService(self):
+        self.add('a')
+        self.add('b')
+        self.add('a')
+        self.assertEqual([r.name for r in self.resolves], ['a', 'b'])
+        self.assertEqual(len(self.reactor.readers), 3)
+
+    def test_resolverKeepsReporting(self):
+        self.add('a')
+        self.reply(self.resolves[0], 1234)
+        self.reply(self.resolves[0], 4321)
+        self.assertEqual(self.results, [('a', 1234), ('a', 4321)])
+        self.assertFalse(self.resolves[0].closed)
+
+    def test_goodbyeStopsResolverAfterGrace(self):
+        self.add('a')
+        self.remove('a')
+        self.assertFalse(self.resolves[0].closed)
+        self.reactor.advance(twistbonjour.RESOLVER_GRACE_PERIOD)
+        self.assertTrue(self.resolves[0].closed)
+        self.assertEqual(len(self.reactor.readers), 1)
+
+    def test_addWithinGraceKeepsResolver(self):
+        self.add('a')
+        self.remove('a')
+        self.add('a')
+        self.reactor.advance(twistbonjour.RESOLVER_GRACE_PERIOD)
+        self.assertFalse(self.resolves[0].closed)
+        self.assertEqual(len(self.resolves), 1)
+
+    def test_addAfterTeardownResolvesAgain(self):
+        self.add('a')
+        self.remove('a')
+        self.reactor.advance(twistbonjour.RESOLVER_GRACE_PERIOD)
+        self.add('a')
+        self.assertEqual([r.name for r in self.resolves], ['a', 'a'])
+        self.assertFalse(self.resolves[1].closed)
+
+    def test_stopBrowsingStopsResolvers(self):
+        self.add('a')
+        self.add('b')
+        self.remove('b')
+        self.browser.stopBrowsing()
+        self.assertTrue(all(r.closed for r in self.resolves))
+        self.assertEqual(self.reactor.readers, set())
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+class BonjourDescriptorTestCase(FakeRefMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.processed = 0
+        self.onProcess = None
+        self.patch(pybonjour, 'DNSServiceProcessResult', self.fakeProcess)
+
+    def fakeProcess(self, sdRef):
+        os.read(sdRef.fileno(), 1)
+        self.processed += 1
+        if self.onProcess is not None:
+            self.onProcess()
+
+    def makeDescriptor(self, queued):
+        ref = self.makeRef()
+        ref.peer.sendall('x' * queued)
+        return twistbonjour.BonjourDescriptor(ref, self.reactor)
+
+    def test_idleWakeupProcessesNothing(self):
+        desc = self.makeDescriptor(0)
+        desc.doRead()
+        self.assertEqual(self.processed, 0)
+
+    def test_drainIsCapped(self):
+        cap = twistbonjour.MAX_RESULTS_PER_READ
+        desc = self.makeDescriptor(cap + 8)
+        desc.doRead()
+        self.assertEqual(self.processed, cap)
+        desc.doRead()
+        self.assertEqual(self.processed, cap + 8)
+
+    def test_drainStopsWhenCallbackCloses(self):
+        desc = self.makeDescriptor(5)
+        self.onProcess = desc.close
+        desc.doRead()
+        self.assertEqual(self.processed, 1)
+        self.assertIdentical(desc.sdRef, None)
+
+    def test_highFileDescriptor(self):
+        highFd = 1500
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= highFd:
+            raise unittest.SkipTest("fd %d is above the open-file limit"
+                                    % highFd)
+        ref = self.makeRef()
+        os.dup2(ref.sock.fileno(), highFd)
+        self.addCleanup(os.close, highFd)
+        ref.fileno = lambda: highFd
+        ref.peer.sendall('xx')
+        desc = twistbonjour.BonjourDescriptor(ref, self.reactor)
+        desc.doRead()
+        self.assertEqual(self.processed, 2)
+
+
+class BonjourDescriptorCloseTestCase(FakeRefMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = RunningReactor()
+        self.ref = self.makeRef()
+        self.desc = twistbonjour.BonjourDescriptor(self.ref, self.reactor)
+
+    def test_closeUsesThreadPoolWhileRunning(self):
+        self.desc.close()
+        self.assertIdentical(self.desc.sdRef, None)
+        self.assertFalse(self.ref.closed)
+        self.assertEqual(self.reactor.threadpool.calls, [self.ref.close])
+
+    def test_closeIsSynchronousWhenStopped(self):
+        self.reactor.running = False
+        self.desc.close()
+        self.assertTrue(self.ref.closed)
+        self.assertEqual(self.reactor.threadpool.calls, [])
+
+    def test_closeFromCallbackIsSynchronous(self):
+        def process(sdRef):
+            os.read(sdRef.fileno(), 1)
+            self.desc.close()
+            self.assertTrue(self.ref.closed)
+        self.patch(self.desc, '_process', process)
+        self.ref.peer.sendall('x')
+        self.desc.doRead()
+        self.assertTrue(self.ref.closed)
+        self.assertEqual(self.reactor.threadpool.calls, [])
+
+    def test_connectionLostIsSynchronous(self):
+        self.desc.connectionLost(None)
+        self.assertTrue(self.ref.closed)
+        self.assertEqual(self.reactor.threadpool.calls, [])
+
+
+class BonjourAdvertiserTestCase(FakeRefMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.registered = []
+        self.patch(pybonjour, 'DNSServiceRegister', self.fakeRegister)
+
+    def fakeRegister(self, flags, interfaceIndex, name, regtype, domain,
+                     host, port, txtRecord, callback):
+        self.registered.append(txtRecord)
+        return self.makeRef(name, callback)
+
+    def makeAdvertiser(self, txtRecord):
+        return twistbonjour.BonjourAdvertiser('echo', '_echo._tcp', 8000,
+                                              None, self.reactor,
+                                              txtRecord=txtRecord)
+
+    def test_encodedRecordIsRegistered(self):
+        record = pybonjour.TXTRecord({'client_id': 'station-1'})
+        ba = self.makeAdvertiser(record)
+        ba.startAdvertising()
+        self.assertEqual(self.registered, [str(record)])
+        self.assertEqual(ba.txtLen, len(str(record)))
+
+    def test_noRecord(self):
+        ba = self.makeAdvertiser(None)
+        ba.startAdvertising()
+        self.assertEqual(self.registered, [None])
+
+    def test_reassignedRecordIsRegistered(self):
+        ba = self.makeAdvertiser('\x05old=1')
+        ba.startAdvertising()
+        ba.stopAdvertising()
+        ba.txtRecord = '\x05new=1'
+        ba.startAdvertising()
+        self.assertEqual(self.registered, ['\x05old=1', '\x05new=1'])
+        self.assertEqual(ba.txtRecord, '\x05new=1')
@@ -11,12 +11,15 @@ __docformat__ = "restructuredtext en"
 #  the file COPYING, distributed as part of this software.
 #*****************************************************************************
 
+import select
+
 import pybonjour
 
 from twisted.internet.interfaces import IReadDescriptor
 from twisted.internet import reactor
 from twisted.python import log
 from twisted.internet import defer
+from twisted.internet import threads
 from twisted.spread import pb
 from zope.interface import implements, classImplements
 
@@ -48,7 +51,15 @@ class BonjourResolveError(BonjourError):
         return "Bonjour Resolve Error: %i" % self.errorCode    
 
 
-class BonjourDescriptor(object,log.Logger):
+# Seconds to wait after a goodbye before tearing down the service's
+# resolver, so a service that flaps off and on keeps its resolver.
+RESOLVER_GRACE_PERIOD = 0.5
+
+# Upper bound on replies handled per reactor wakeup, so a flood of
+# answers cannot starve the other descriptors.
+MAX_RESULTS_PER_READ = 32
+
+class BonjourDescriptor(object):
     """Integrates a Bonjour file desc. into the Twisted event loop.
     The user should not create instances of this class directly.  They
     should instead be created by the higher level classes like
@@ -56,34 +67,105 @@ class BonjourDescriptor(object,log.Logger):
 
     implements(IReadDescriptor)
 
-    def __init__(self, sdRef):
+    __slots__ = ('sdRef', 'reactor', '_fd', '_process', '_poller',
+                 '_inRead')
+
+    def __init__(self, sdRef, reactor):
         """Wrap a Bonjour file descriptor
 
-        @arg fd: file Descriptor to wrap
-        @type fd: int
         @arg sdRef: Initialized ServiceDiscovery reference
+        @arg reactor: The Twisted reactor the descriptor is added to
         """
         self.sdRef = sdRef
+        self.reactor = reactor
+        # The reactor asks for fileno() on every pass, so cache it.
+        self._fd = sdRef.fileno()
+        self._process = pybonjour.DNSServiceProcessResult
+        self._inRead = False
+        # select() cannot take fds >= FD_SETSIZE, so use poll() for the
+        # readiness check where it exists (everywhere but Windows).
+        if hasattr(select, 'poll'):
+            self._poller = select.poll()
+            self._poller.register(self._fd, select.POLLIN)
+        else:
+            self._poller = None
+
+    def logPrefix(self):
+        """Return a prefix for log messages from this descriptor."""
+        return '-'
 
     def fileno(self):
         """Return the raw file descriptor"""
-        return self.sdRef.fileno()
+        return self._fd
 
     def doRead(self):
-        """Called by the Twited event loop when the fd is ready to read."""
-        ret = pybonjour.DNSServiceProcessResult(self.sdRef)
+        """Called by the Twited event loop when the fd is ready to read.
+
+        DNSServiceProcessResult blocks until a reply arrives, so it is
+        only called while a zero-timeout poll() reports the fd readable;
+        a spurious wakeup returns without calling it.  Replies already
+        queued on the socket are processed in the same wakeup, up to
+        MAX_RESULTS_PER_READ.
+        """
+        process = self._process
+        poller = self._poller
+        self._inRead = True
+        try:
+            for i in xrange(MAX_RESULTS_PER_READ):
+                # A callback may have stopped the operation.
+                if self.sdRef is None:
+                    break
+                if poller is not None:
+                    if not poller.poll(0):
+                        break
+                elif not select.select([self._fd], [], [], 0)[0]:
+                    break
+                process(self.sdRef)
+        finally:
+            self._inRead = False
+
+    def close(self, inThread=True):
+        """Deallocate the ServiceDiscovery reference.
+
+        DNSServiceRefDeallocate talks to the daemon and can block, so while
+        the reactor is running it is done in the reactor's thread pool.
+        It is done here instead when the reactor is not running, since the
+        pool may never run the work, and when called from a callback inside
+        doRead, since the ref may only be deallocated on the thread that is
+        still inside DNSServiceProcessResult for it.  The reference is
+        dropped right away so it cannot be used again.
+
+        @arg inThread: Set to False to always deallocate synchronously
+        @type inThread: bool
+        """
+        sdRef, self.sdRef = self.sdRef, None
+        self._fd = -1
+        self._poller = None
+        if sdRef is None:
+            return
+        if inThread and self.reactor.running and not self._inRead:
+            d = threads.deferToThreadPool(self.reactor,
+                                          self.reactor.getThreadPool(),
+                                          sdRef.close)
+            d.addErrback(log.err)
+        else:
+            sdRef.close()
 
     def connectionLost(self, reason):
         """Called by the Twisted event loop when things are shutting down."""
         log.msg("Stopping Bonjour Advertisement")
-        if self.sdRef is not None:
-            #pybonjour.DNSServiceRefDeallocate(self.sdRef)
-            self.sdRef.close()
-            self.sdRef = None
+        # The thread pool is stopped along with the reactor, so work
+        # queued now could be dropped and the service never deregistered.
+        self.close(inThread=False)
 
 
 class BonjourAdvertiser(object):
     """Advertise a service using Bonjour."""
+
+    __slots__ = ('name', 'regtype', 'domain', 'port', 'reactor', 'callback',
+                 'flags', 'interfaceIndex', 'host', 'txtLen', '_txtRecord',
+                 '_txtBytes', 'context', 'sdRef', 'bonjourDesc')
+
     def __init__(self, name, regtype, port, callback, reactor,
                  flags=0, interfaceIndex=0, domain='local',host='', 
                  txtLen=0, txtRecord=None, context=None):
@@ -120,6 +202,22 @@ class BonjourAdvertiser(object):
         self.context = context
         self.sdRef = None
 
+    def _getTxtRecord(self):
+        return self._txtRecord
+
+    def _setTxtRecord(self, txtRecord):
+        # Encode a TXTRecord once, rather than on every registration.
+        self._txtRecord = txtRecord
+        if txtRecord is not None:
+            self._txtBytes = str(txtRecord)
+            self.txtLen = len(self._txtBytes)
+        else:
+            self._txtBytes = None
+
+    txtRecord = property(_getTxtRecord, _setTxtRecord, doc=
+        """The TXT record to register.  It is encoded when assigned, so
+        reassign it after changing a TXTRecord in place.""")
+
     def startAdvertising(self):
         """Advertise the service with Bonjour.
         This method returns a deferred.  Upon success, the result
@@ -135,7 +233,7 @@ class BonjourAdvertiser(object):
                                            self.domain,
                                            self.host,
                                            self.port,
-                                           self.txtRecord,
+                                           self._txtBytes,
                                            self.callback,
                                            )
 
@@ -146,7 +244,7 @@ class BonjourAdvertiser(object):
 
         # Get the file descriptor and integrate with twisted
 
-        self.bonjourDesc = BonjourDescriptor(self.sdRef)
+        self.bonjourDesc = BonjourDescriptor(self.sdRef, self.reactor)
         self.reactor.addReader(self.bonjourDesc)
 
         return None
@@ -156,14 +254,16 @@ class BonjourAdvertiser(object):
 
         # Remove the Reader Deallocate the serviceReference
         self.reactor.removeReader(self.bonjourDesc)
-        if self.sdRef is not None:
-        #    pybonjour.DNSServiceRefDeallocate(self.sdRef)
-            self.sdRef.close()
-            self.sdRef = None
+        self.bonjourDesc.close()
+        self.sdRef = None
 
 class BonjourBrowser(object):
     """Browse for a Bonjour advertised service."""
 
+    __slots__ = ('sdRef', 'regtype', 'domain', 'reactor', 'resolveCallback',
+                 'flags', 'interfaceIndex', 'context', '_resolvers',
+                 '_pendingRemovals', 'bonjourDesc')
+
     def __init__(self, regtype, callback, reactor,
                  flags=0, interfaceIndex=0, domain='local', 
                  context=None):
@@ -195,7 +295,10 @@ class BonjourBrowser(object):
         self.flags = flags
         self.interfaceIndex = interfaceIndex
         self.context = context
-        self.resolvers = []
+        # (serviceName, regtype, domain) -> BonjourResolver
+        self._resolvers = {}
+        # (serviceName, regtype, domain) -> pending teardown DelayedCall
+        self._pendingRemovals = {}
 
     def startBrowsing(self):
         """Advertise the service with Bonjour.
@@ -211,7 +314,7 @@ class BonjourBrowser(object):
                                                 self.domain,
                                                 self.browseCallback)
 
-        self.bonjourDesc = BonjourDescriptor(self.sdRef)
+        self.bonjourDesc = BonjourDescriptor(self.sdRef, self.reactor)
         self.reactor.addReader(self.bonjourDesc)
 
         return None
@@ -221,9 +324,15 @@ class BonjourBrowser(object):
 
         # Remove the Reader Deallocate the serviceReference
         self.reactor.removeReader(self.bonjourDesc)
-        if self.sdRef is not None:
-            self.sdRef.close()
-            self.sdRef = None
+        self.bonjourDesc.close()
+        self.sdRef = None
+
+        for call in self._pendingRemovals.values():
+            call.cancel()
+        self._pendingRemovals.clear()
+        for res in self._resolvers.values():
+            res.stopResolving()
+        self._resolvers.clear()
 
     def browseCallback(self, sdRef, flags, interfaceIndex, errorCode, serviceName,
                     regtype, replyDomain):
@@ -235,17 +344,39 @@ class BonjourBrowser(object):
             self.serviceRemovedCallback(serviceName,regtype,replyDomain)
             return
 
+        key = (serviceName, regtype, replyDomain)
+        pending = self._pendingRemovals.pop(key, None)
+        if pending is not None:
+            pending.cancel()
+        if key in self._resolvers:
+            return
+
         res = BonjourResolver(serviceName,regtype,self.resolveCallback,
                               self.reactor,flags,interfaceIndex,replyDomain)
         res.startResolving()
-        #self.resolvers.append(res)
+        self._resolvers[key] = res
+
     def serviceRemovedCallback(self, serviceName, regtype, relpyDomain):
         log.msg("Service Removed")
+        key = (serviceName, regtype, relpyDomain)
+        if key in self._resolvers and key not in self._pendingRemovals:
+            self._pendingRemovals[key] = self.reactor.callLater(
+                RESOLVER_GRACE_PERIOD, self._removeResolver, key)
+
+    def _removeResolver(self, key):
+        """Tear down the resolver for a service that has gone away."""
+        del self._pendingRemovals[key]
+        res = self._resolvers.pop(key, None)
+        if res is not None:
+            res.stopResolving()
 
 
 class BonjourResolver(object):
     """Resolve a Bonjour service."""
 
+    __slots__ = ('sdRef', 'name', 'regtype', 'domain', 'reactor', 'callback',
+                 'flags', 'interfaceIndex', 'bonjourDesc')
+
     def __init__(self, name, regtype, callback, reactor,
                  flags=0, interfaceIndex=0, domain='local', 
                  context=None):
@@ -295,7 +426,7 @@ class BonjourResolver(object):
                                                  self.domain,
                                                  self.callback)
 
-        self.bonjourDesc = BonjourDescriptor(self.sdRef)
+        self.bonjourDesc = BonjourDescriptor(self.sdRef, self.reactor)
         self.reactor.addReader(self.bonjourDesc)
 
         return None
@@ -305,9 +436,8 @@ class BonjourResolver(object):
 
         # Remove the Reader Deallocate the serviceReference
         self.reactor.removeReader(self.bonjourDesc)
-        if self.sdRef is not None:
-            self.sdRef.close()
-            self.sdRef = None
+        self.bonjourDesc.close()
+        self.sdRef = None
 
 class PBServerFactoryBonjour(pb.PBServerFactory):
     """A replacement for PBServerFactory that enables Bonjour Registration."""
@@ -315,7 +445,7 @@ class PBServerFactoryBonjour(pb.PBServerFactory):
     def __init__(self, root, serviceName, 
                  serviceType, servicePort, unsafeTracebacks=False):
 
-        pb.PBServerFactory(root, unsafeTracebacks)
+        pb.PBServerFactory.__init__(self, root, unsafeTracebacks)
         self.serviceName = serviceName
         self.serviceType = serviceType
         self.servicePort = servicePort
@@ -333,9 +463,9 @@ class PBServerFactoryBonjour(pb.PBServerFactory):
 
     def registrationCallback(self, sdRef, flags, errorCode, name, regtype, domain):
         if errorCode == pybonjour.kDNSServiceErr_NoError:
-            print errorCode, name, regtype, domain
+            log.msg("%s %s %s %s" % (errorCode, name, regtype, domain))
         else:
-            print "Bonjour registration error"
+            log.msg("Bonjour registration error: %s" % errorCode)
 
 #def listenTCP(port, factory, backlog=50, interface='', serviceName):
 #    def listenTCP(self, port, factory, backlog=50, interface='')